@@ -24,6 +24,8 @@ import logging
 import msgpack
 import errno
 import signal
+import json
+import base64
 
 # pip packages
 import gevent
@@ -31,7 +33,7 @@ import gevent.subprocess
 import gevent.queue
 import gevent.socket as socket
 from gevent.server import StreamServer
-from gevent.pool import Pool
+from gevent.pool import Group
 from gevent.coros import RLock
 from gevent import Timeout
 from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo
@@ -39,10 +41,34 @@ from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo
 # delimiter for end of socket messages
 SOCKET_DELIMITER = b'--NETRNG-SOCKET-DELIMITER'
 
+# environment variables used to pass inherited sockets across a binary upgrade
+HANDOFF_LISTENER_ENV = 'NETRNG_LISTENER_FD'
+HANDOFF_CLIENTS_ENV = 'NETRNG_CLIENT_FDS'
+
+# seconds to wait for busy client handlers to finish sending a response
+# before a binary upgrade, handlers waiting for a request or for the entropy
+# source are parked immediately
+HANDOFF_TIMEOUT = 1
+
+# seconds the client waits for a server response, long enough to cover a
+# binary upgrade of the server (see Server.handoff)
+RESPONSE_TIMEOUT = 10
+
 # library logger
 log = logging.getLogger('netrng')
 
 
+class ClientHandoff(gevent.GreenletExit):
+    '''
+        Raised in a client handler to park its connection for a binary upgrade,
+        request holds a received request the new process should answer
+
+    '''
+    def __init__(self, request=b''):
+        gevent.GreenletExit.__init__(self, request)
+        self.request = request
+
+
 class Server(object):
     '''
         NetRNG server
@@ -94,6 +120,22 @@ class Server(object):
         
         # lock to prevent multiple clients from getting the same random samples
         self.rng_lock = RLock()
+
+        # greenlets serving connected clients, max_clients is enforced when
+        # accepting new connections so it can change while clients are connected
+        self.clients = Group()
+
+        # client handlers that can be parked for handoff, mapped to the
+        # request they haven't answered yet
+        self.idle_clients = {}
+
+        # StreamServer accepting client connections, created by listen()
+        self.server = None
+
+        # set during a binary upgrade, client handlers park a copy of their
+        # socket in handoff_clients instead of serving more requests
+        self.handoff_pending = False
+        self.handoff_clients = []
         
         self.use_zeroconf = use_zeroconf
         
@@ -113,35 +155,64 @@ class Server(object):
         log.info('NetRNG server: unregistering all bonjour services')
         self.zeroconf_controller.unregister_all_services()
 
-    def serve(self, sock, address):
+    def serve(self, sock, address, request=b''):
         '''
             Serves client connections providing random samples to them in a one-to-many 
             request response architecture, with locking to ensure each client gets unique
             samples
+
+            request holds a request received by the process that handed the
+            client off, it is answered before reading from the socket
     
         '''
         log.debug('NetRNG server: client connected %s', address)
+        handler = gevent.getcurrent()
+        buffered = request
 
         try:
             while True:
+                if self.handoff_pending:
+                    raise ClientHandoff()
                 log.debug('NetRNG server: receive cycle start')
-                requestmsg = b""
+                requestmsg = buffered
+                buffered = b""
                 with Timeout(3, gevent.Timeout):
-                    while True:
-                        data = sock.recv(1024)
+                    while SOCKET_DELIMITER not in requestmsg:
+                        # between requests the handler can be parked at any
+                        # time, see park()
+                        if not requestmsg:
+                            self.idle_clients[handler] = b""
+                        try:
+                            data = sock.recv(1024)
+                        finally:
+                            self.idle_clients.pop(handler, None)
                         requestmsg = requestmsg + data
                         log.debug('NetRNG server: receive cycle')
                         if SOCKET_DELIMITER in requestmsg:
                             break
                         gevent.sleep()
+                # requests arriving during a handoff are answered by the new
+                # process, so the entropy source isn't read here
+                if self.handoff_pending:
+                    raise ClientHandoff(requestmsg)
+                rawrequest = requestmsg
                 requestmsg = requestmsg.replace(SOCKET_DELIMITER, b'')
                 request = msgpack.unpackb(requestmsg)
                 log.debug('NetRNG server: receive cycle done')
                 log.debug('NetRNG server: request received %s', request)
                 if request[b'get'] == b'sample':
-                    with self.rng_lock:
+                    # waiting for the entropy source can be parked too, the
+                    # request is handed off with the client
+                    self.idle_clients[handler] = rawrequest
+                    try:
+                        self.rng_lock.acquire()
+                    finally:
+                        self.idle_clients.pop(handler, None)
+                    try:
                         log.debug('NetRNG server: rng lock acquired')
                         sample = self.hwrng.read(self.sample_size_bytes)
+                    finally:
+                        self.rng_lock.release()
                     log.debug('NetRNG server: rng lock released')
                     log.debug('NetRNG server: sending response')
                     responsemsg = msgpack.packb({b'push': b'sample', b'sample': sample})
@@ -150,6 +221,11 @@ class Server(object):
                     log.debug('NetRNG server: sending heartbeat response to %s', address)
                     responsemsg = msgpack.packb({b'push': b'heartbeat'})
                     sock.sendall(responsemsg + SOCKET_DELIMITER)
+        except ClientHandoff as handoff:
+            # the socket passed to serve() is closed when the handler exits,
+            # park a duplicate for the new process
+            log.debug('NetRNG server: parking client %s for handoff', address)
+            self.handoff_clients.append((sock.dup(), address, handoff.request))
         except socket.error as e:
             if isinstance(e.args, tuple):
                 if e[0] == errno.EPIPE:
@@ -184,19 +260,41 @@ class Server(object):
         received_entropy_per_second = received_entropy_size / calibration_period
         log.info('NetRNG server: entropy source can provide %.2f bytes per second', received_entropy_per_second)
 
-    def start(self):
+    def listen(self):
         '''
             Server starts listening on a TCP socket and spawns a greenlet for each
-            new connection. Blocks caller.
+            new connection. Does not block.
+
+            If the process was started by handoff(), the inherited listening
+            socket and client connections are used instead of binding again
 
         '''
-        self.pool = Pool(self.max_clients)
-        self.server = StreamServer((self.listen_address, self.port), self.serve, spawn=self.pool)
+        listener = self.inherited_listener()
+        if listener is not None and listener.getsockname()[:2] != (self.listen_address, self.port):
+            log.info('NetRNG server: listen address changed from %s:%d, binding again', *listener.getsockname()[:2])
+            listener.close()
+            listener = None
+        if listener is None:
+            listener = (self.listen_address, self.port)
+        self.server = StreamServer(listener, self.serve, spawn=self.spawn_client)
+        # accept one connection per wakeup so update_accepting() can stop
+        # accepting as soon as max_clients is reached
+        self.server.max_accept = 1
         log.info('NetRNG server: serving up to %d connections on %s:%d)', self.max_clients, self.listen_address, self.port)
+        self.server.start()
+        for sock, address, request in self.inherited_clients():
+            self.adopt(sock, address, request)
+        self.update_accepting()
+        if self.use_zeroconf:
+            self.broadcast_service()
+
+    def start(self):
+        '''
+            Server starts listening and serving clients. Blocks caller.
+
+        '''
         try:
-            self.server.start()
-            if self.use_zeroconf:
-                self.broadcast_service()
+            self.listen()
             gevent.wait()
         except KeyboardInterrupt as e:
             log.debug('NetRNG server: exiting due to keyboard interrupt')
@@ -213,6 +311,205 @@ class Server(object):
         if self.use_zeroconf:
             self.unregister_service()
         self.server.stop()
+        self.clients.kill()
+
+
+    def spawn_client(self, func, *args):
+        '''
+            Spawns a client handler, used by the StreamServer for accepted
+            connections and by adopt() for existing ones
+
+        '''
+        greenlet = self.clients.spawn(func, *args)
+        greenlet.link(self.update_accepting)
+        self.update_accepting()
+        return greenlet
+
+
+    def update_accepting(self, *args):
+        '''
+            Accepts new connections only while fewer than max_clients are
+            connected. Clients beyond the limit after a reload stay connected
+
+        '''
+        if self.server is None or not self.server.started or self.handoff_pending:
+            return
+        if len(self.clients) >= self.max_clients:
+            self.server.stop_accepting()
+        else:
+            self.server.start_accepting()
+
+
+    def adopt(self, sock, address, request=b''):
+        '''
+            Starts serving an already connected client socket
+
+        '''
+        return self.spawn_client(self.serve, sock, address, request)
+
+
+    def reload(self, max_clients=None, sample_size_bytes=None, hwrng_device=None):
+        '''
+            Applies new settings to the running server without closing client
+            connections. Settings left as None are unchanged
+
+        '''
+        log.info('NetRNG server: reloading configuration')
+
+        # open the new device before touching the old one, so a bad path
+        # leaves the server running with the current device
+        hwrng = None
+        if hwrng_device is not None and hwrng_device != self.hwrng_device:
+            hwrng = open(hwrng_device, 'rb')
+
+        with self.rng_lock:
+            if hwrng is not None:
+                log.info('NetRNG server: switching entropy source to %s', hwrng_device)
+                self.hwrng.close()
+                self.hwrng = hwrng
+                self.hwrng_device = hwrng_device
+            if sample_size_bytes is not None and sample_size_bytes != self.sample_size_bytes:
+                log.info('NetRNG server: sample size changed to %d bytes', sample_size_bytes)
+                self.sample_size_bytes = sample_size_bytes
+
+        if max_clients is not None and max_clients != self.max_clients:
+            log.info('NetRNG server: max_clients changed to %d', max_clients)
+            self.max_clients = max_clients
+            self.update_accepting()
+
+
+    def handoff(self):
+        '''
+            Replaces the running process with a fresh copy of netrngd, passing
+            the listening socket and client connections to it through
+            inherited file descriptors. The process id stays the same, so init
+            systems keep tracking the daemon.
+
+            If anything fails before the exec, the server resumes serving
+
+        '''
+        if self.handoff_pending:
+            log.warning('NetRNG server: handoff already in progress')
+            return
+        log.info('NetRNG server: starting handoff to new process')
+        self.handoff_pending = True
+        try:
+            self.server.stop_accepting()
+
+            # idle handlers are parked right away, busy ones park after sending
+            # their response and anything still busy after the timeout is closed
+            loop = gevent.get_hub().loop
+            for greenlet in list(self.clients):
+                loop.run_callback(self.park, greenlet)
+            self.clients.join(timeout=HANDOFF_TIMEOUT)
+            if len(self.clients):
+                log.warning('NetRNG server: dropping %d busy clients for handoff', len(self.clients))
+            self.clients.kill()
+
+            if self.use_zeroconf:
+                self.unregister_service()
+                self.zeroconf_controller.close()
+                self.zeroconf_controller = None
+
+            listener_fd = self.server.socket.fileno()
+            client_fds = [(sock.fileno(), address, base64.b64encode(request).decode('ascii'))
+                          for sock, address, request in self.handoff_clients]
+            for fd in [listener_fd] + [fd for fd, address, request in client_fds]:
+                if hasattr(os, 'set_inheritable'):
+                    os.set_inheritable(fd, True)
+
+            env = dict(os.environ)
+            env[HANDOFF_LISTENER_ENV] = str(listener_fd)
+            env[HANDOFF_CLIENTS_ENV] = json.dumps(client_fds)
+            argv = [sys.executable] + sys.argv
+            log.info('NetRNG server: handing off listener and %d clients to %s', len(client_fds), ' '.join(argv))
+            self.hwrng.close()
+            os.execve(sys.executable, argv, env)
+        except Exception as e:
+            log.exception('NetRNG server: handoff failed, resuming service: %s', e)
+            self.resume()
+
+
+    def park(self, greenlet):
+        '''
+            Parks a client handler for handoff if it is waiting for a new
+            request or for the entropy source. Runs in the hub, so the handler
+            can't wake up in between
+
+        '''
+        if greenlet in self.idle_clients:
+            greenlet.throw(ClientHandoff(self.idle_clients[greenlet]))
+
+
+    def resume(self):
+        '''
+            Resumes serving parked clients and accepting connections after a
+            failed handoff()
+
+        '''
+        self.handoff_pending = False
+        clients = self.handoff_clients
+        self.handoff_clients = []
+        if self.hwrng.closed:
+            try:
+                self.hwrng = open(self.hwrng_device, 'rb')
+            except IOError as e:
+                log.exception('NetRNG server: unable to reopen %s: %s', self.hwrng_device, e)
+        for sock, address, request in clients:
+            self.adopt(sock, address, request)
+        self.update_accepting()
+        if self.use_zeroconf:
+            try:
+                if self.zeroconf_controller is None:
+                    self.zeroconf_controller = Zeroconf()
+                self.broadcast_service()
+            except Exception as e:
+                log.exception('NetRNG server: unable to register zeroconf service: %s', e)
+
+
+    def inherited_listener(self):
+        '''
+            Returns the listening socket passed in by handoff(), or None
+
+        '''
+        fd = os.environ.pop(HANDOFF_LISTENER_ENV, None)
+        if fd is None:
+            return None
+        log.info('NetRNG server: using inherited listening socket')
+        fd = int(fd)
+        listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        return listener
+
+
+    def inherited_clients(self):
+        '''
+            Returns the (socket, address, request) client connections passed
+            in by handoff()
+
+        '''
+        clients = []
+        for fd, address, request in json.loads(os.environ.pop(HANDOFF_CLIENTS_ENV, '[]')):
+            log.debug('NetRNG server: adopting inherited client %s', address)
+            sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+            clients.append((sock, tuple(address), base64.b64decode(request)))
+        return clients
+
+
+def close_inherited_sockets():
+    '''
+        Closes sockets passed in by Server.handoff() when netrngd was
+        restarted in a mode that doesn't serve them
+
+    '''
+    fds = [fd for fd, address, request in json.loads(os.environ.pop(HANDOFF_CLIENTS_ENV, '[]'))]
+    listener_fd = os.environ.pop(HANDOFF_LISTENER_ENV, None)
+    if listener_fd is not None:
+        fds.append(int(listener_fd))
+    for fd in fds:
+        log.info('NetRNG: closing inherited socket %d', fd)
+        os.close(fd)
 
 
 
@@ -338,7 +635,7 @@ class Client(object):
                 # wait for response
                 log.debug('NetRNG client: receive cycle start')
                 responsemsg = b""
-                with Timeout(2, gevent.Timeout):
+                with Timeout(RESPONSE_TIMEOUT, gevent.Timeout):
                     while True:
                         data = server_socket.recv(1024)
                         responsemsg = responsemsg + data
@@ -22,8 +22,12 @@ import time
 import sys
 import os
 import logging
+import signal
 from six.moves import configparser
 
+# pip packages
+import gevent
+
 # local modules
 import netrng.core
 
@@ -49,8 +53,21 @@ config_defaults.update(global_defaults)
 config_defaults.update(server_defaults)
 config_defaults.update(client_defaults)
 
-netrng_config = configparser.ConfigParser(defaults=config_defaults)
-netrng_config.read('/etc/netrng.conf')
+CONFIG_FILE = '/etc/netrng.conf'
+
+# settings that only take effect after a restart or handoff, not a reload,
+# changing mode always requires a restart
+handoff_options = [('Global', 'port'),
+                   ('Global', 'debug'),
+                   ('Global', 'zeroconf'),
+                   ('Server', 'listen_address')]
+
+def load_config():
+    config = configparser.ConfigParser(defaults=config_defaults)
+    config.read(CONFIG_FILE)
+    return config
+
+netrng_config = load_config()
 
 # logging level
 DEBUG = netrng_config.getboolean('Global', 'debug')
@@ -97,18 +114,48 @@ def main():
                               hwrng_device=hwrng_device,
                               use_zeroconf=use_zeroconf)
 
+        def reload_config():
+            global netrng_config
+            log.info('NetRNG: SIGHUP received, reloading %s', CONFIG_FILE)
+            try:
+                config = load_config()
+                if config.get('Global', 'mode') != mode:
+                    log.warning('NetRNG: mode changed, restart netrngd to apply it')
+                for section, option in handoff_options:
+                    if config.get(section, option) != netrng_config.get(section, option):
+                        log.warning('NetRNG: %s changed, restart netrngd or send SIGUSR2 to apply it', option)
+                server.reload(max_clients=config.getint('Server', 'max_clients'),
+                              sample_size_bytes=config.getint('Server', 'sample_size_bytes'),
+                              hwrng_device=config.get('Server', 'hwrng_device'))
+                netrng_config = config
+            except Exception as e:
+                log.exception('NetRNG: reload failed, keeping current configuration: %s', e)
+
+        def handoff():
+            log.info('NetRNG: SIGUSR2 received, handing off to new process')
+            new_mode = load_config().get('Global', 'mode')
+            if new_mode != 'server':
+                log.error('NetRNG: mode changed to %s, restart netrngd instead of handing off', new_mode)
+                return
+            server.handoff()
+
+        gevent.signal(signal.SIGHUP, reload_config)
+        gevent.signal(signal.SIGUSR2, handoff)
+
         try:
             server.start()
         finally:
             server.stop()
 
     elif mode == 'client':
+        netrng.core.close_inherited_sockets()
         server_address = netrng_config.get('Client', 'server_address')
 
         client = netrng.core.Client(server_address=server_address, port=port, use_zeroconf=use_zeroconf)
         client.start()
 
     else:
+        netrng.core.close_inherited_sockets()
         log.error('NetRNG: no mode selected, quitting')
         sys.exit(1)
 
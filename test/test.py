@@ -3,9 +3,52 @@
 from __future__ import absolute_import
 
 import sys
+import os
+import json
+import time
+import errno
+import signal
+import tempfile
+import subprocess
+
+import msgpack
+import gevent
+import gevent.socket as socket
 
 import netrng.core
 
+def make_server(max_clients=2):
+    return netrng.core.Server(listen_address='127.0.0.1',
+                          port=0,
+                          max_clients=max_clients,
+                          sample_size_bytes=2048,
+                          hwrng_device='/dev/zero',
+                          use_zeroconf=False)
+
+def connect(server):
+    return socket.create_connection(('127.0.0.1', server.server.server_port))
+
+def send_request(sock, get=b'heartbeat'):
+    sock.sendall(msgpack.packb({b'get': get}) + netrng.core.SOCKET_DELIMITER)
+
+def read_response(sock, timeout=1):
+    responsemsg = b""
+    with gevent.Timeout(timeout):
+        while netrng.core.SOCKET_DELIMITER not in responsemsg:
+            responsemsg = responsemsg + sock.recv(1024)
+    return msgpack.unpackb(responsemsg.replace(netrng.core.SOCKET_DELIMITER, b''))
+
+def heartbeat(sock):
+    send_request(sock)
+    assert read_response(sock)[b'push'] == b'heartbeat'
+
+def assert_not_served(sock):
+    try:
+        read_response(sock, timeout=0.3)
+    except gevent.Timeout:
+        return
+    raise AssertionError('connection was served')
+
 def test_server():
     server = netrng.core.Server(listen_address='127.0.0.1',
                           port=8989,
@@ -13,12 +56,223 @@ def test_server():
                           sample_size_bytes=2048,
                           hwrng_device='/dev/zero',
                           use_zeroconf=False)
-    
+
+def test_server_reload():
+    server = make_server()
+    server.reload(max_clients=4, sample_size_bytes=1024, hwrng_device='/dev/urandom')
+    assert server.max_clients == 4
+    assert server.sample_size_bytes == 1024
+    assert server.hwrng_device == '/dev/urandom'
+    assert len(server.hwrng.read(server.sample_size_bytes)) == 1024
+    server.hwrng.close()
+
+def test_server_reload_max_clients():
+    server = make_server(max_clients=2)
+    server.listen()
+    socks = []
+    try:
+        socks = [connect(server), connect(server)]
+        for sock in socks:
+            heartbeat(sock)
+
+        # the server is full, a new connection waits in the listen backlog
+        socks.append(connect(server))
+        send_request(socks[2])
+        assert_not_served(socks[2])
+
+        # lowering the limit keeps existing clients connected
+        server.reload(max_clients=1)
+        assert_not_served(socks[2])
+        heartbeat(socks[0])
+        heartbeat(socks[1])
+
+        # raising it accepts the waiting connection
+        server.reload(max_clients=3)
+        assert read_response(socks[2])[b'push'] == b'heartbeat'
+
+        socks.append(connect(server))
+        send_request(socks[3])
+        assert_not_served(socks[3])
+    finally:
+        for sock in socks:
+            sock.close()
+        server.stop()
+        server.hwrng.close()
+
+def test_server_handoff_resume():
+    execve_envs = []
+    def execve(path, argv, env):
+        execve_envs.append(env)
+        raise OSError(errno.ENOENT, 'not found')
+    original_execve = netrng.core.os.execve
+    netrng.core.os.execve = execve
+    server = make_server(max_clients=2)
+    server.listen()
+    socks = []
+    try:
+        socks = [connect(server), connect(server)]
+        for sock in socks:
+            heartbeat(sock)
+
+        # both handlers are idle, so they are parked without waiting
+        started = time.time()
+        server.handoff()
+        assert time.time() - started < netrng.core.HANDOFF_TIMEOUT
+
+        env = execve_envs[0]
+        assert env[netrng.core.HANDOFF_LISTENER_ENV] == str(server.server.socket.fileno())
+        assert len(json.loads(env[netrng.core.HANDOFF_CLIENTS_ENV])) == 2
+
+        # the failed exec resumes serving parked clients and new connections
+        assert not server.handoff_pending
+        assert len(server.clients) == 2
+        for sock in socks:
+            heartbeat(sock)
+        send_request(socks[0], b'sample')
+        assert len(read_response(socks[0])[b'sample']) == 2048
+        server.reload(max_clients=3)
+        socks.append(connect(server))
+        heartbeat(socks[2])
+
+        # a handler waiting for the entropy source is parked with its request,
+        # which is answered after resuming
+        server.rng_lock.acquire()
+        send_request(socks[0], b'sample')
+        gevent.sleep(0.1)
+        server.handoff()
+        pending = [base64_request for fd, address, base64_request in json.loads(execve_envs[1][netrng.core.HANDOFF_CLIENTS_ENV])]
+        assert len([request for request in pending if request]) == 1
+        server.rng_lock.release()
+        assert len(read_response(socks[0])[b'sample']) == 2048
+    finally:
+        netrng.core.os.execve = original_execve
+        for sock in socks:
+            sock.close()
+        server.stop()
+        server.hwrng.close()
+
+def test_server_inherited_sockets():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    conn, address = listener.accept()
+    os.environ[netrng.core.HANDOFF_LISTENER_ENV] = str(os.dup(listener.fileno()))
+    os.environ[netrng.core.HANDOFF_CLIENTS_ENV] = json.dumps([(os.dup(conn.fileno()), address, 'cmVxdWVzdA==')])
+    server = make_server()
+    inherited_listener = server.inherited_listener()
+    inherited_clients = server.inherited_clients()
+    try:
+        assert netrng.core.HANDOFF_LISTENER_ENV not in os.environ
+        assert netrng.core.HANDOFF_CLIENTS_ENV not in os.environ
+        assert inherited_listener.getsockname() == listener.getsockname()
+        assert len(inherited_clients) == 1
+        sock, inherited_address, request = inherited_clients[0]
+        assert inherited_address == tuple(address)
+        assert request == b'request'
+        client.sendall(b'netrng')
+        assert sock.recv(6) == b'netrng'
+    finally:
+        inherited_listener.close()
+        for sock, inherited_address, request in inherited_clients:
+            sock.close()
+        for sock in [listener, client, conn]:
+            sock.close()
+        server.hwrng.close()
+
+def test_server_inherited_listener_rebind():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    os.environ[netrng.core.HANDOFF_LISTENER_ENV] = str(os.dup(listener.fileno()))
+    server = make_server()
+    try:
+        # the configured port differs, so the inherited listener is replaced
+        server.listen()
+        assert server.server.server_port != listener.getsockname()[1]
+        heartbeat_sock = connect(server)
+        heartbeat(heartbeat_sock)
+        heartbeat_sock.close()
+    finally:
+        listener.close()
+        server.stop()
+        server.hwrng.close()
+
+HANDOFF_SCRIPT = '''
+import sys
+import signal
+import logging
+import gevent
+import netrng.core
+
+logging.basicConfig(level=logging.INFO)
+server = netrng.core.Server(listen_address='127.0.0.1',
+                      port=int(sys.argv[1]),
+                      max_clients=2,
+                      sample_size_bytes=2048,
+                      hwrng_device='/dev/zero',
+                      use_zeroconf=False)
+# gevent 1.5 renamed gevent.signal to gevent.signal_handler
+signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+signal_handler(signal.SIGUSR2, server.handoff)
+server.start()
+'''
+
+def test_server_handoff_exec():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    script = tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False)
+    script.write(HANDOFF_SCRIPT)
+    script.close()
+    output = tempfile.TemporaryFile()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, script.name, str(port)], stdout=output, stderr=output, env=env)
+    socks = []
+    try:
+        for attempt in range(50):
+            try:
+                socks.append(socket.create_connection(('127.0.0.1', port)))
+                break
+            except socket.error:
+                gevent.sleep(0.1)
+        socks.append(socket.create_connection(('127.0.0.1', port)))
+        for sock in socks:
+            heartbeat(sock)
+
+        # the clients keep their connections across the exec
+        process.send_signal(signal.SIGUSR2)
+        gevent.sleep(0.5)
+        for sock in socks:
+            send_request(sock, b'sample')
+            assert len(read_response(sock, timeout=netrng.core.RESPONSE_TIMEOUT)[b'sample']) == 2048
+        assert process.poll() is None
+    finally:
+        for sock in socks:
+            sock.close()
+        process.terminate()
+        process.wait()
+        os.unlink(script.name)
+    output.seek(0)
+    log = output.read()
+    output.close()
+    assert b'handing off listener and 2 clients' in log
+    assert b'using inherited listening socket' in log
+
 def test_client():
     client = netrng.core.Client(server_address='127.0.0.1', port=8989, use_zeroconf=False)
 
 if __name__ == '__main__':
     test_server()
+    test_server_reload()
+    test_server_reload_max_clients()
+    test_server_handoff_resume()
+    test_server_inherited_sockets()
+    test_server_inherited_listener_rebind()
+    test_server_handoff_exec()
     test_client()
     sys.exit(0)
     
\ No newline at end of file